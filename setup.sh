@@ -9,4 +9,4 @@ sudo apt install openssl
 
 # Python dependencies
 echo -e "\n[*] Installing Python2 dependencies...\n"
-sudo pip2 install 'pefile>=2019.4.18' distorm3 pycrypto
+sudo pip2 install 'pefile>=2019.4.18' distorm3 pycrypto asn1crypto cryptography numpy
@@ -20,11 +20,19 @@ import re
 import json
 import pefile
 import struct
+import collections
 import sigvalidator
+import multiprocessing
+import multiprocessing.pool
 
-from io import BytesIO
 from enum import Enum
 
+# NumPy is optional, PE checksums are summed with struct otherwise
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import volatility.debug as debug
 import volatility.utils as utils
 import volatility.win32.tasks as tasks
@@ -36,8 +44,22 @@ import volatility.plugins.malware.devicetree as dtree
 from volatility.renderers import TreeGrid
 from volatility.plugins.common import AbstractWindowsCommand
 
-CERTIFICATE_REGEX = re.compile(b'\x30.\x30.\x06.(?P<oid_algorithm>.{5,9})\x05\x00\x04(?P<hash_size>.)')
-OPENSSL_REGEX = re.compile(r' *(?P<offset>[0-9]+):d=[0-9]+ +hl=(?P<header_length>[0-9]+) +l= *(?P<length>[0-9]+)')
+# Path prefixes of modules, and their FileObject notation. Most specific first
+PATH_REPLACEMENTS = [
+                        ('\\SystemRoot', '\\Device\\HarddiskVolume*\\Windows'),
+                        ('\\\\\\?\\C:', '\\Device\\HarddiskVolume*'),
+                        ('C:', '\\Device\\HarddiskVolume*')
+                    ]
+# Volume number is replaced by '*' in canonical paths
+VOLUME_PREFIX = '\\device\\harddiskvolume'
+
+# SigCheck instance used by worker processes, inherited through fork()
+_worker_plugin = None
+
+def _validate_content(is_complete, content, object_type, name):
+    if is_complete:
+        return _worker_plugin.validate_content(content, object_type, name)
+    return _worker_plugin.validate_partial_content(content, object_type, name)
 
 class ReturnCode(Enum):
     FILEOBJECT_ERROR = (1, 'Unable to read FileObject')
@@ -73,6 +95,7 @@ class SigCheck(AbstractWindowsCommand):
         --catalog [dir]: directory containing catalog files (.cat), default to '$PWD/catroot/$VOL_PROFILE'
         --dll: verify library modules (.dll)
         --sys: verify driver modules (.sys)
+        --jobs [n]: number of processes verifying modules, default to 1
     '''
 
     def __init__(self, config, *args, **kwargs):
@@ -87,13 +110,19 @@ class SigCheck(AbstractWindowsCommand):
         self._config.add_option('CATALOG', help='Catalog dir to search signature into, default to \'$PWD/catroot/$VOL_PROFILE\'', action='store', type='string', default=default_catlog_dir)
         self._config.add_option('DLL', help='Verify DLL modules (.dll)', action='store_true')
         self._config.add_option('SYS', help='Verify driver modules (.sys)', action='store_true')
+        self._config.add_option('JOBS', help='Number of processes verifying modules, default to 1', action='store', type='int', default=1)
         self.addr_space = utils.load_as(self._config)
 
-        self.files = []
+        # FileObjects, only scanned when a module has to be looked up
+        self.files = None
+        # FileObjects by canonical path
+        self._files_by_canonical = None
         self.frequent_addresses = self.load_frequent_addresses()
         # Simple cache
         self.already_analyzed = {}
         self.sigv = None
+        # DumpFiles plugin, created on first FileObject extraction
+        self._dumper = None
 
     def load_frequent_addresses(self):
         try:
@@ -121,6 +150,14 @@ class SigCheck(AbstractWindowsCommand):
         if self._config.DLL and self._config.SYS:
             self.__debug_message('error', 'Incompatible options: either exe (default), or exe with dll (--dll), or sys (--sys)')
 
+        if self._config.JOBS < 1:
+            self.__debug_message('error', '\'{0}\': Invalid number of processes (--jobs)'.format(self._config.JOBS))
+
+        # Workers rely on fork() to inherit plugin state
+        if self._config.JOBS > 1 and os.name == 'nt':
+            self.__debug_message('warning', 'Multiple processes (--jobs) are not supported on this platform, using only one')
+            self._config.JOBS = 1
+
     def calculate(self):
         '''
         Main plugin function
@@ -139,30 +176,93 @@ class SigCheck(AbstractWindowsCommand):
                 modules += self.get_pe_modules(task, dlls=self._config.DLL)
 
         if modules:
-            self.files = self.get_files()
+            pool = self.create_pool() if self._config.JOBS > 1 else None
+            # Results waiting to be yielded in module order, so that workers are kept busy
+            pending = collections.deque()
+            window = 2 * self._config.JOBS if pool else 0
 
-            for module in modules:
-                module_path, module_name, pid = module
-                if module_path in self.already_analyzed:
-                    yield module_name, pid, self.already_analyzed[module_path]
-                else:
-                    if module_path:
+            try:
+                for module in modules:
+                    module_path, module_name, pid = module
+                    if module_path in self.already_analyzed:
+                        pending.append((module_name, pid, module_path, self.already_analyzed[module_path]))
+                    elif module_path:
                         is_complete, file_object = self.get_file_object(module_path)
-                        # We found a complete FileObject to work on
-                        if is_complete:
-                            result = self.validate_file(file_object)
-                            self.already_analyzed[module_path] = result
-                            yield module_name, pid, result
-                        # We are restricted to likely find signature in last page
-                        else:
-                            result = self.validate_partial_file(file_object)
-                            self.already_analyzed[module_path] = result
-                            yield module_name, pid, result
+                        result = self.schedule_validation(pool, is_complete, file_object)
+                        self.already_analyzed[module_path] = result
+                        pending.append((module_name, pid, module_path, result))
                     # Sometimes, terminated processes are still listed
                     elif task.ExitTime:
-                        yield task.ImageFileName, pid, ReturnCode.ALREADY_TERMINATED
+                        pending.append((task.ImageFileName, pid, None, ReturnCode.ALREADY_TERMINATED))
                     else:
-                        yield task.ImageFileName, pid, ReturnCode.NOT_PEB
+                        pending.append((task.ImageFileName, pid, None, ReturnCode.NOT_PEB))
+
+                    while len(pending) > window:
+                        yield self.get_result(*pending.popleft())
+
+                while pending:
+                    yield self.get_result(*pending.popleft())
+
+                if pool:
+                    pool.close()
+                    pool.join()
+            finally:
+                # Output stopped before all modules were verified
+                if pool:
+                    pool.terminate()
+
+    def create_pool(self):
+        '''
+        Creates worker processes validating FileObjects content
+
+        @return a multiprocessing.Pool
+        '''
+
+        global _worker_plugin
+        _worker_plugin = self
+
+        # Catalog files are parsed once, instead of once per worker
+        self.sigv.get_catalog_digests()
+
+        return multiprocessing.Pool(self._config.JOBS)
+
+    def schedule_validation(self, pool, is_complete, file_object):
+        '''
+        Validates a FileObject, either right now or by a worker process if pool is given
+
+        @param pool: multiprocessing.Pool, or None
+        @param is_complete: whether FileObject is complete
+        @param file_object: FileOject dict
+
+        @return verification result, or a multiprocessing.pool.ApplyResult
+        '''
+
+        if not pool:
+            # We found a complete FileObject to work on
+            if is_complete:
+                return self.validate_file(file_object)
+            # We are restricted to likely find signature in last page
+            return self.validate_partial_file(file_object)
+
+        if not file_object:
+            return ReturnCode.FILEOBJECT_ERROR
+
+        # Memory is only read by this process, workers are given its content
+        content = self.read_file_memory(file_object)
+        return pool.apply_async(_validate_content, (is_complete, content, file_object['type'], file_object['name']))
+
+    def get_result(self, module_name, pid, module_path, result):
+        '''
+        Waits for a verification result, and caches it
+
+        @return a tuple of process name, process identifier, and process verification result
+        '''
+
+        if isinstance(result, multiprocessing.pool.ApplyResult):
+            result = result.get()
+            self.already_analyzed[module_path] = result
+
+        return module_name, pid, result
 
     def get_files(self):
         '''
@@ -242,33 +342,78 @@ class SigCheck(AbstractWindowsCommand):
         if filename:
             # Use same notation
             filename = self.normalize_filepath(filename)
-            for f in self.files:
-                # We consider they are the same file if executable path and file object path match
-                if re.match(r'^{0}$'.format(filename), f['name'], flags=re.IGNORECASE):
-                    return self.extract_object(f)
+            # Unresolvable paths cannot match any file object, do not scan for them
+            if filename is None:
+                return False, None
+
+            # We consider they are the same file if executable path and file object path match
+            files = self.get_files_by_canonical().get(filename)
+            if files:
+                return self.extract_object(files[0])
 
         return False, None
 
+    def get_files_by_canonical(self):
+        '''
+        Retrieves and indexes all FileObjects the first time a module is looked up. Memory dump is not scanned
+        if no module needs it
+
+        @return a dict of lists of FileObjects, by canonical path
+        '''
+
+        if self._files_by_canonical is None:
+            self.files = self.get_files()
+            self._files_by_canonical = self.index_files(self.files)
+
+        return self._files_by_canonical
+
+    def index_files(self, files):
+        '''
+        Groups FileObjects by canonical path, to look modules up without scanning all of them
+
+        @param files: list of FileObjects, as returned by get_files
+
+        @return a dict of lists of FileObjects, in original order, by canonical path
+        '''
+
+        ret = {}
+
+        for f in files:
+            ret.setdefault(self.canonicalize_filepath(f['name']), []).append(f)
+
+        return ret
+
     def normalize_filepath(self, filepath):
         '''
         Converts filepath to use uniform notation
 
         @param filepath
 
-        @return normalized filepath
+        @return canonical filepath, or None if filepath prefix is unknown
         '''
 
-        to_replace = {
-                        '\\SystemRoot': '\\\\Device\\\\HarddiskVolume[0-9]\\\\Windows',
-                        '\\\\\\?\\C:': '\\\\Device\\\\HarddiskVolume[0-9]',
-                        'C:': '\\\\Device\\\\HarddiskVolume[0-9]'
-                    }
-
-        for key in to_replace.keys():
+        for key, replacement in PATH_REPLACEMENTS:
             path = filepath.split(key)
 
             if len(path) == 2:
-                return to_replace[key] + re.escape(path[1])
+                return self.canonicalize_filepath(replacement + path[1])
+
+    def canonicalize_filepath(self, filepath):
+        '''
+        Lowercases a FileObject path and replaces its volume number (single digit) by '*'
+
+        @param filepath: v.g: '\\Device\\HarddiskVolume2\\Windows\\explorer.exe'
+
+        @return canonical filepath, v.g: '\\device\\harddiskvolume*\\windows\\explorer.exe'
+        '''
+
+        filepath = filepath.lower()
+        volume_end = len(VOLUME_PREFIX) + 1
+
+        if filepath.startswith(VOLUME_PREFIX) and filepath[volume_end-1:volume_end].isdigit():
+            filepath = VOLUME_PREFIX + '*' + filepath[volume_end:]
+
+        return filepath
 
     def extract_object(self, file_object):
         '''
@@ -280,11 +425,14 @@ class SigCheck(AbstractWindowsCommand):
         @return a FileObject
         '''
 
-        self._config.DUMP_DIR = '.'     # Dummy value
+        # Same plugin instance is reused, only FileObject offset changes between extractions
+        if not self._dumper:
+            self._config.DUMP_DIR = '.'     # Dummy value
+            self._dumper = dumpfiles.DumpFiles(self._config)
+
         self._config.PHYSOFFSET =  hex(file_object['offset'])
-        dumper = dumpfiles.DumpFiles(self._config)
 
-        for dumpfile in dumper.calculate():
+        for dumpfile in self._dumper.calculate():
             try:
                 # File fully memory resident
                 if dumpfile['present'] and not dumpfile['pad']:
@@ -308,17 +456,31 @@ class SigCheck(AbstractWindowsCommand):
 
         # Read actual memory data
         content = self.read_file_memory(file_object)
-        file_type = self.get_pe_type(file_object)
+
+        return self.validate_content(content, file_object['type'], file_object['name'])
+
+    def validate_content(self, content, object_type, name):
+        '''
+        Validates signature of FileObject content, already read from memory
+
+        @param content: FileObject content
+        @param object_type: either 'ImageSectionObject' or 'DataSectionObject'
+        @param name: FileObject name
+
+        @result string with verification process result
+        '''
+
+        file_type = self.get_pe_type(name)
 
         # We need to undo executable relocation 
-        if file_object['type'] == 'ImageSectionObject':
+        if object_type == 'ImageSectionObject':
             return self.validate_image_section(content, file_type)
         # Data is represented as on-disk, maybe with padding at the end
-        elif file_object['type'] == 'DataSectionObject':
+        elif object_type == 'DataSectionObject':
             return self.validate_data_section(content)
 
-    def get_pe_type(self, file_object):
-        return file_object['name'].split('.')[-1].lower()
+    def get_pe_type(self, name):
+        return name.split('.')[-1].lower()
 
     def read_file_memory(self, file_object):
         '''
@@ -326,69 +488,212 @@ class SigCheck(AbstractWindowsCommand):
 
         @param file_object: FileOject dict
 
-        @returns str buffer with all FileObject content
+        @returns bytearray with all FileObject content
         '''
 
-        of = BytesIO()
-
-        # memory_model = self.addr_space.profile.metadata.get('memory_model', '32bit')
-
+        # mdata[0] = memory offset to read
+        # mdata[1] = offset in file reconstruction
+        # mdata[2] = amount of bytes to read
         for mdata in file_object['present']:
             # DumpFiles official plugin does not handle addresses correctly
             # V.g: 0x20002790a000 instead of 0x2790a000
             mdata[0] &= 0xffffffff
 
-            # mdata[0] = memory offset to read
-            # mdata[1] = offset in file reconstruction
-            # mdata[2] = amount of bytes to read
-            rdata = self.addr_space.base.read(mdata[0], mdata[2])
+        # memory_model = self.addr_space.profile.metadata.get('memory_model', '32bit')
 
-            of.seek(mdata[1])
-            if rdata:
-                of.write(rdata)
+        # Coalesce pages contiguous both in memory and in file reconstruction, to read them at once
+        runs = []
+        for mdata in sorted(file_object['present']):
+            if runs and runs[-1][0] + runs[-1][2] == mdata[0] and runs[-1][1] + runs[-1][2] == mdata[1]:
+                runs[-1][2] += mdata[2]
+                runs[-1][3] += [mdata]
             else:
-                self.__debug_message('warning', 'Unable to read memory for file object \'{0}\' at address {1:#x}'.format(file_object['name'], mdata[0]))
+                runs += [[mdata[0], mdata[1], mdata[2], [mdata]]]
 
-        content = of.getvalue()
-        of.close()
+        of = bytearray(max([mdata[1] + mdata[2] for mdata in file_object['present']] or [0]))
+        size = 0
 
-        return content
+        for memory_offset, file_offset, length, pages in runs:
+            reads = [(memory_offset, file_offset, self.addr_space.base.read(memory_offset, length))]
+
+            # A single unreadable page fails the whole read, retry page by page
+            if not reads[0][2] and len(pages) > 1:
+                reads = [(mdata[0], mdata[1], self.addr_space.base.read(mdata[0], mdata[2])) for mdata in pages]
+
+            for memory_offset, file_offset, rdata in reads:
+                if rdata:
+                    of[file_offset:file_offset+len(rdata)] = rdata
+                    size = max(size, file_offset + len(rdata))
+                else:
+                    self.__debug_message('warning', 'Unable to read memory for file object \'{0}\' at address {1:#x}'.format(file_object['name'], memory_offset))
+
+        # Content ends with last page actually read
+        del of[size:]
+
+        return of
 
     def validate_image_section(self, content, file_type):
-        content = self.delete_padding(content)
-        pe = pefile.PE(data=content, fast_load=True)
-        is_32bits = self.is_32bits(content)
+        context = self.delete_padding(content)
+
+        if context.pe.verify_checksum():
+            return self.verify_pe(context)
 
-        if pe.verify_checksum():
-            return self.verify_pe(pe)
+        relocations = self.get_relocations(context.pe)
+        if relocations is None:
+            return ReturnCode.PE_REBUILT_FAILED
+
+        # Rebuild all candidates in place on a single copy, there is no need to parse nor copy the image for each one
+        data = bytearray(context.content)
+        imagebase = context.pe.OPTIONAL_HEADER.ImageBase
 
         for new_imagebase in self.frequent_addresses[file_type]:
             new_imagebase = int(new_imagebase, 16)
 
-            if is_32bits and new_imagebase > 0xffffffff:
+            if context.is_32 and new_imagebase > 0xffffffff:
                 continue
 
             try:
-                pe = pefile.PE(data=content, fast_load=True)
-                pe.relocate_image(new_imagebase)
-                new_content = self.set_imagebase(new_imagebase, pe.__data__)
-                pe = pefile.PE(data=new_content, fast_load=True)
-
-                if pe.verify_checksum():
-                    return self.verify_pe(pe)
-            # AttributeError: Some PE files doesn't have relocation table
-            # struct.error: Some times pe.get_data_from_qword() fails during relocation
-            except (AttributeError, struct.error):
-                pass
+                self.relocate_image(data, relocations, new_imagebase - imagebase)
+                self.set_imagebase(new_imagebase, data, context.layout)
+            # struct.error: Relocated value out of range, also raised by pe.relocate_image()
+            except struct.error:
+                continue
+
+            # Only parse candidates whose checksum matches
+            if self.calculate_checksum(data, context.checksum_addr) == context.pe.OPTIONAL_HEADER.CheckSum:
+                return self.verify_pe(self.sigv.get_pe_context(data))
 
         return ReturnCode.PE_REBUILT_FAILED
 
-    def verify_pe(self, pe):
-        cert = self.sigv.extract_cert(pe)
+    def get_relocations(self, pe):
+        '''
+        Gets base relocation fixups of a PE file, along with their original value, so they can be applied
+        from scratch for any ImageBase
+
+        @param pe: pefile.PE object
+
+        @return a list of tuples of relocation type, file offset, original value, and next entry RVA
+                (only for IMAGE_REL_BASED_HIGHADJ); or None if relocation table is unusable
+        '''
+
+        ret = []
+
+        # Same behaviour as pe.relocate_image()
+        if not pe.OPTIONAL_HEADER.DATA_DIRECTORY[pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_BASERELOC']].Size:
+            return ret
+
+        if not hasattr(pe, 'DIRECTORY_ENTRY_BASERELOC'):
+            pe.parse_data_directories(directories=[pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_BASERELOC']])
+
+        # Some PE files doesn't have a valid relocation table
+        if not hasattr(pe, 'DIRECTORY_ENTRY_BASERELOC'):
+            return None
+
+        formats = {
+                    pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGH']: '<H',
+                    pefile.RELOCATION_TYPE['IMAGE_REL_BASED_LOW']: '<H',
+                    pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGHLOW']: '<I',
+                    pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGHADJ']: '<H',
+                    pefile.RELOCATION_TYPE['IMAGE_REL_BASED_DIR64']: '<Q'
+                }
+
+        for reloc in pe.DIRECTORY_ENTRY_BASERELOC:
+            entries = iter(reloc.entries)
+            for entry in entries:
+                if entry.type not in formats:
+                    continue
+
+                next_rva = None
+                # IMAGE_REL_BASED_HIGHADJ uses next entry as well
+                if entry.type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGHADJ']:
+                    next_entry = next(entries, None)
+                    if not next_entry:
+                        break
+                    next_rva = next_entry.rva
+
+                size = struct.calcsize(formats[entry.type])
+                offset = pe.get_physical_by_rva(entry.rva)
+
+                # Fixup outside file data, pe.relocate_image() fails as well
+                try:
+                    if offset is None or len(pe.get_data(entry.rva, size)) != size:
+                        return None
+                except pefile.PEFormatError:
+                    return None
+
+                value = struct.unpack_from(formats[entry.type], pe.__data__, offset)[0]
+                ret += [(entry.type, offset, value, next_rva)]
+
+        return ret
+
+    def relocate_image(self, data, relocations, relocation_difference):
+        '''
+        Applies base relocations in place, as pe.relocate_image() does
+
+        @param data: PE raw data (bytearray)
+        @param relocations: fixups as returned by get_relocations
+        @param relocation_difference: new ImageBase minus original ImageBase
+        '''
+
+        for relocation_type, offset, value, next_rva in relocations:
+            if relocation_type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGH']:
+                struct.pack_into('<H', data, offset, (value + (relocation_difference >> 16)) & 0xffff)
+            elif relocation_type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_LOW']:
+                struct.pack_into('<H', data, offset, (value + relocation_difference) & 0xffff)
+            elif relocation_type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGHLOW']:
+                struct.pack_into('<I', data, offset, value + relocation_difference)
+            elif relocation_type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_HIGHADJ']:
+                struct.pack_into('<H', data, offset, ((value << 16) + next_rva + relocation_difference & 0xffff0000) >> 16)
+            elif relocation_type == pefile.RELOCATION_TYPE['IMAGE_REL_BASED_DIR64']:
+                struct.pack_into('<Q', data, offset, value + relocation_difference)
+
+    def calculate_checksum(self, data, checksum_addr):
+        '''
+        Calculates OptionalHeader.CheckSum, as pe.generate_checksum() does, without parsing PE file
+
+        @param data: PE raw data
+        @param checksum_addr: OptionalHeader.CheckSum offset
+
+        @return checksum
+        '''
+
+        dwords = len(data) // 4
+        checksum = 0
+        # Skip the checksum field
+        checksum_field = struct.unpack_from('<I', data, checksum_addr // 4 * 4)[0]
+
+        # Carries are folded at the end, so 16-bit words add up to the same checksum than dwords
+        if numpy and dwords:
+            checksum += int(numpy.frombuffer(data, dtype='<u2', count=dwords*2).sum(dtype=numpy.uint64))
+            checksum -= (checksum_field & 0xffff) + (checksum_field >> 16)
+        else:
+            # Sum dwords by chunks, avoiding a huge tuple
+            for i in range(0, dwords, 0x4000):
+                count = min(0x4000, dwords - i)
+                checksum += sum(struct.unpack_from('<{0}I'.format(count), data, i*4))
+            checksum -= checksum_field
+
+        # Last dword is padded with null-bytes
+        remainder = len(data) % 4
+        if remainder:
+            checksum += self.unpack_dword(bytes(data[dwords*4:]) + b'\x00' * (4 - remainder))
+
+        while checksum >> 32:
+            checksum = (checksum & 0xffffffff) + (checksum >> 32)
+
+        checksum = (checksum & 0xffff) + (checksum >> 16)
+        checksum = checksum + (checksum >> 16)
+        checksum = checksum & 0xffff
+
+        # The length is the one of the original data, not the padded one
+        return checksum + len(data)
+
+    def verify_pe(self, context):
+        cert = self.sigv.extract_cert(context)
         if cert:
             algorithm, hash_file = self.sigv.get_digest_from_signature(cert)
             if algorithm:
-                digest = self.sigv.calculate_pe_digest(algorithm, pe.__data__)
+                digest = self.sigv.calculate_pe_digest(algorithm, context)
                 if hash_file == digest:
                     return self.sigv.verify_signature(cert)
                 else:
@@ -397,41 +702,35 @@ class SigCheck(AbstractWindowsCommand):
                 return ReturnCode.PARTIAL_CERTIFICATE
         else:
             for algorithm in ['md5', 'sha1', 'sha256']:
-                digest = self.sigv.calculate_pe_digest(algorithm, pe.__data__)
+                digest = self.sigv.calculate_pe_digest(algorithm, context)
                 if self.sigv.is_in_catalog(digest):
                     return ReturnCode.CATALOG_SIGNED
 
             return ReturnCode.NOT_SIGNED
 
     def get_imagebase(self, content):
-        nt_headers_addr = self.get_nt_header_addr(content)
-
-        if self.is_32bits(content):
-            return self.unpack_dword(content[nt_headers_addr+0x34:nt_headers_addr+0x34+0x4])
-        elif self.is_64bits(content):
-            return self.unpack_qword(content[nt_headers_addr+0x30:nt_headers_addr+0x30+0x8])
+        return self.sigv.parse_pe_layout(content)['imagebase']
 
-    def set_imagebase(self, imagebase, content):
-        nt_headers_addr = self.get_nt_header_addr(content)
+    def set_imagebase(self, imagebase, content, layout=None):
+        '''
+        Sets OptionalHeader.ImageBase in place
 
-        if self.is_32bits(content):
-            return content[:nt_headers_addr+0x34] + self.pack_dword(imagebase) + content[nt_headers_addr+0x34+0x4:]
-        elif self.is_64bits(content):
-            return content[:nt_headers_addr+0x30] + self.pack_qword(imagebase) + content[nt_headers_addr+0x30+0x8:]
+        @param imagebase: new ImageBase
+        @param content: PE raw data (bytearray)
+        @param layout: header layout of content, if already parsed
 
-    def is_32bits(self, content):
-        nt_headers_addr = self.get_nt_header_addr(content)
-            
-        magic = content[nt_headers_addr+0x18:nt_headers_addr+0x18+0x2]
+        @return content
+        '''
 
-        return magic == b'\x0B\x01'
+        if not layout:
+            layout = self.sigv.parse_pe_layout(content)
 
-    def is_64bits(self, content):
-        nt_headers_addr = self.get_nt_header_addr(content)
-            
-        magic = content[nt_headers_addr+0x18:nt_headers_addr+0x18+0x2]
+        if layout['is_32']:
+            struct.pack_into('<I', content, layout['imagebase_addr'], imagebase)
+        elif layout['is_64']:
+            struct.pack_into('<Q', content, layout['imagebase_addr'], imagebase)
 
-        return magic == b'\x0B\x02'
+        return content
 
     def get_pe_section(self, pe, section_name):
         for section in pe.sections:
@@ -449,16 +748,15 @@ class SigCheck(AbstractWindowsCommand):
         '''
 
         # Sometimes, there is padding at the end of buffer
-        content = self.delete_padding(content)
-        pe = pefile.PE(data=content, fast_load=True)
+        context = self.delete_padding(content)
 
         # Ensure there are no extraction errors
-        if pe.verify_checksum():
+        if context.pe.verify_checksum():
             # Files can has an embedded signature
-            cert = self.sigv.extract_cert(pe)
+            cert = self.sigv.extract_cert(context)
             if cert:
                 algorithm, hash_file = self.sigv.get_digest_from_signature(cert)
-                digest = self.sigv.calculate_pe_digest(algorithm, content)
+                digest = self.sigv.calculate_pe_digest(algorithm, context)
                 if hash_file == digest:
                     return self.sigv.verify_signature(cert)
                 else:
@@ -467,27 +765,13 @@ class SigCheck(AbstractWindowsCommand):
             else:
                 # Calculate algorithm hash to later search in catalog files
                 for algorithm in ['md5', 'sha1', 'sha256']:
-                    digest = self.sigv.calculate_pe_digest(algorithm, content)
+                    digest = self.sigv.calculate_pe_digest(algorithm, context)
                     if self.sigv.is_in_catalog(digest):
                         return ReturnCode.CATALOG_SIGNED
                 return ReturnCode.NOT_SIGNED
         else:
             return ReturnCode.PE_CHECKSUM_MISMATCH
 
-    def get_nt_header_addr(self, pe_data):
-        '''
-        Gets NtHeader offset
-
-        @param pe_data: PE raw data
-
-        @return NtHeader offset
-        '''
-        if pe_data[:2] == b'\x4D\x5A':              # MZ
-            nt_headers_addr = self.unpack_dword(pe_data[0x3c:0x3c+0x04])
-            nt_headers = pe_data[nt_headers_addr:nt_headers_addr+0x04]
-            if nt_headers == b'\x50\x45\x00\x00':   # PE
-                return nt_headers_addr
-
     def unpack_dword(self, bytes_):
         return struct.unpack('<I', bytes_)[0]
 
@@ -502,30 +786,31 @@ class SigCheck(AbstractWindowsCommand):
 
     def delete_padding(self, content):
         '''
-        Deletes padding of SectionObject containing an executable
+        Deletes padding of SectionObject containing an executable, parsing it only once
 
         @param content: with padding
 
-        @return content without padding
+        @return PEContext of content without padding
         '''
 
-        real_size = self.calculate_pe_size(content)
-        content = content[:real_size]
+        # Assume PE file is well formed
+        pe = pefile.PE(data=content, fast_load=True)
+        content = content[:self.calculate_pe_size(pe)]
+        # Parsed headers lie before padding, only data read later (checksum, sections) has to be trimmed
+        pe.__data__ = content
 
-        return content
+        return self.sigv.get_pe_context(content, pe)
 
-    def calculate_pe_size(self, data):
+    def calculate_pe_size(self, pe):
         '''
         Calculate the size of an executable adding size of PE headers, all sections,
         and Authenticode signature
 
-        @param data: executable data
+        @param pe: pefile.PE object of executable
 
         @return executable size
         '''
 
-        # Assume PE file is well formed
-        pe = pefile.PE(data=data, fast_load=True)
         # PE Headers
         size = pe.NT_HEADERS.OPTIONAL_HEADER.SizeOfHeaders
         # All sections
@@ -539,29 +824,32 @@ class SigCheck(AbstractWindowsCommand):
     def validate_partial_file(self, file_object):
         if file_object:
             content = self.read_file_memory(file_object)
-            try:
-                pe = pefile.PE(data=content, fast_load=True)
-                if self.sigv.has_cert(pe):
-                    if file_object['type'] == 'DataSectionObject':
-                        cert = self.sigv.extract_cert(pe)
-                        if cert:
-                            return '{0:s}. Signature verification: {1}'.format(ReturnCode.PARTIAL_CONTENT_VERIFIED, self.sigv.verify_signature(cert))
-                        else:
-                            return ReturnCode.CONTENT_SIGNED_NOT_VERIFIED
-                    # SecurityDirectory entry is not mappped into memory in ImageSectionObject
-                    elif file_object['type'] == 'ImageSectionObject':
-                        return ReturnCode.CONTENT_SIGNED_NOT_VERIFIED
-                else:
-                    # Microsoft programs in 'C:\Windows' are usually catalog-signed
-                    if re.match(r'\Device\HarddiskVolume[0-9]\Windows', file_object['name']):
-                        return ReturnCode.PARTIAL_CONTENT_MAYBE_CATALOG_SIGNED
-
-                    return ReturnCode.PARTIAL_CONTENT_NOT_SIGNED
-            except pefile.PEFormatError:
-                return ReturnCode.PARTIAL_CONTENT_PE_DATA_ERROR
+            return self.validate_partial_content(content, file_object['type'], file_object['name'])
         else:
             return ReturnCode.FILEOBJECT_ERROR
 
+    def validate_partial_content(self, content, object_type, name):
+        try:
+            context = self.sigv.get_pe_context(content)
+            if self.sigv.has_cert(context):
+                if object_type == 'DataSectionObject':
+                    cert = self.sigv.extract_cert(context)
+                    if cert:
+                        return '{0:s}. Signature verification: {1}'.format(ReturnCode.PARTIAL_CONTENT_VERIFIED, self.sigv.verify_signature(cert))
+                    else:
+                        return ReturnCode.CONTENT_SIGNED_NOT_VERIFIED
+                # SecurityDirectory entry is not mappped into memory in ImageSectionObject
+                elif object_type == 'ImageSectionObject':
+                    return ReturnCode.CONTENT_SIGNED_NOT_VERIFIED
+            else:
+                # Microsoft programs in 'C:\Windows' are usually catalog-signed
+                if re.match(r'\Device\HarddiskVolume[0-9]\Windows', name):
+                    return ReturnCode.PARTIAL_CONTENT_MAYBE_CATALOG_SIGNED
+
+                return ReturnCode.PARTIAL_CONTENT_NOT_SIGNED
+        except pefile.PEFormatError:
+            return ReturnCode.PARTIAL_CONTENT_PE_DATA_ERROR
+
     def __debug_message(self, type_, message):
         getattr(debug, type_)('{0}\t: {1}'.format(self.__plugin_name, message))
 
@@ -17,17 +17,65 @@ along with sigcheck.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 import re
+import mmap
 import pefile
+import stat
 import struct
 import hashlib
 import binascii
+import datetime
 import tempfile
+import threading
 import subprocess
 
 from enum import Enum
-
-CERTIFICATE_REGEX = re.compile(b'\x30.\x30.\x06.(?P<oid_algorithm>.{5,9})\x05\x00\x04(?P<hash_size>.)')
-OPENSSL_REGEX = re.compile(r' *(?P<offset>[0-9]+):d=[0-9]+ +hl=(?P<header_length>[0-9]+) +l= *(?P<length>[0-9]+)')
+from asn1crypto import cms, core, pem, util, x509
+
+# os.scandir() is only available since Python 3.5, scandir package or os.walk() are used otherwise
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Hyperscan is optional, Python re is used otherwise
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# cryptography is optional, openssl is used otherwise
+try:
+    from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding
+except ImportError:
+    default_backend = None
+
+CA_PATH = '/etc/ssl/certs/'
+# Certificates are looked up by subject name hash in CA_PATH, as 'openssl -CApath' does
+CA_PATH_FILE_REGEX = re.compile(r'^[0-9a-f]{8}\.[0-9]+$')
+# Maximum certificate chain length
+MAX_CHAIN_DEPTH = 10
+# Per-user directory where catalog digests are persisted between runs
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sigcheck')
+# Content type of Authenticode signed data
+SPC_INDIRECT_DATA_OBJID = '1.3.6.1.4.1.311.2.1.4'
+
+# Escaped form, Hyperscan expressions cannot contain null-bytes
+CERTIFICATE_PATTERN = br'\x30.\x30.\x06.(?P<oid_algorithm>.{5,9})\x05\x00\x04(?P<hash_size>.)'
+# Backtracking is bounded: pattern starts with a literal, and OID length can only be retried 5 times.
+# Without Hyperscan, it is faster than locating '\x05\x00\x04' with find() and checking prefixes in Python
+CERTIFICATE_REGEX = re.compile(CERTIFICATE_PATTERN)
+# OptionalHeader.Magic: ImageBase offset from NtHeader, fields from ImageBase up to SecurityDirectoryEntry
+# (ImageBase, CheckSum, SecurityDirectoryEntry.VirtualAddress, SecurityDirectoryEntry.Size), SecurityDirectoryEntry offset
+OPTIONAL_HEADER_LAYOUTS = {
+                            0x10b: (0x34, struct.Struct('<I32xI60xII'), 0x98),     # PE32
+                            0x20b: (0x30, struct.Struct('<Q32xI76xII'), 0xa8)      # PE32+
+                          }
 
 class ReturnCode(Enum):
     CERT_EXPIRED = (1, 'Certificate expired')
@@ -48,22 +96,41 @@ class ReturnCode(Enum):
     def __str__(self):
         return self.value[1]
 
+class PEContext:
+    '''
+    PE file parsed once, along with header offsets needed during verification
+    '''
+
+    def __init__(self, content, pe, layout):
+        self.content = content
+        self.pe = pe
+        # Header offsets and fields, see SigValidator.parse_pe_layout()
+        self.layout = layout
+        self.nt_headers_addr = layout['nt_headers_addr']
+        self.is_32 = layout['is_32']
+        self.is_64 = layout['is_64']
+        self.checksum_addr = layout['checksum_addr']
+        # SecurityDirectoryEntry offset, SecurityDirectoryEntry.VirtualAddress, SecurityDirectoryEntry.Size
+        self.cert_table_addr = layout['cert_table_addr']
+        self.cert_va = layout['cert_va']
+        self.cert_size = layout['cert_size']
+
 class SigValidator:
     def __init__(self, catalog=None):
         self.catalog = catalog
-
-        _, self.file_signature = tempfile.mkstemp()
-        _, self.file_signed_data = tempfile.mkstemp()
-
-    def __del__(self):
-        self.clean_workin_dir()
+        self.certificate_db = self.compile_certificate_db()
+        # Digests of all catalog files, built on first lookup
+        self._catalog_digests = None
+        # Certificates of CA_PATH by subject, loaded on first in-process verification
+        self._trust_roots = None
 
     def verify_pe(self, pe, rebuilt=False):
-        cert = self.extract_cert(pe)
+        context = self.get_pe_context(pe.__data__, pe)
+        cert = self.extract_cert(context)
 
         if cert:
             algorithm, hash_file = self.get_digest_from_signature(cert)
-            digest = self.calculate_pe_digest(algorithm, pe.__data__)
+            digest = self.calculate_pe_digest(algorithm, context)
 
             if hash_file == digest:
                 return self.verify_signature(cert)
@@ -75,7 +142,7 @@ class SigValidator:
         else:
             if self.catalog:
                 for algorithm in ['md5', 'sha1', 'sha256']:
-                    digest = self.calculate_pe_digest(algorithm, pe.__data__)
+                    digest = self.calculate_pe_digest(algorithm, context)
 
                     if self.is_in_catalog(digest):
                         return ReturnCode.CATALOG_SIGNED
@@ -85,21 +152,59 @@ class SigValidator:
             else:
                 return ReturnCode.NOT_SIGNED
 
-    def clean_workin_dir(self):
+    def get_pe_context(self, content, pe=None):
         '''
-        Deletes temporary files
+        Parses a PE file and its header offsets once
+
+        @param content: PE raw data
+        @param pe: pefile.PE object of content, if already parsed
+
+        @return PEContext
         '''
 
-        self.delete_file(self.file_signature)
-        self.delete_file(self.file_signed_data)
+        if not pe:
+            pe = pefile.PE(data=content, fast_load=True)
 
-    def delete_file(self, path):
-        if os.path.exists(path):
-            os.remove(path)
+        return PEContext(content, pe, self.parse_pe_layout(content))
 
-    def verify_signature(self, cert):
-        SPC_PE_IMAGE_DATA_OBJID = '1.3.6.1.4.1.311.2.1.15'
+    def parse_pe_layout(self, content):
+        '''
+        Gets header offsets and fields needed during verification, unpacking OptionalHeader once
+
+        @param content: PE raw data
 
+        @return dict with NtHeader offset, bitness, ImageBase offset and value, CheckSum offset,
+                SecurityDirectoryEntry offset, SecurityDirectoryEntry.VirtualAddress and SecurityDirectoryEntry.Size
+        '''
+
+        nt_headers_addr = self.get_nt_header_addr(content)
+        magic = struct.unpack_from('<H', content, nt_headers_addr+0x18)[0]
+
+        layout = {
+                    'nt_headers_addr': nt_headers_addr,
+                    'is_32': magic == 0x10b,
+                    'is_64': magic == 0x20b,
+                    'checksum_addr': nt_headers_addr + 0x58,
+                    'imagebase_addr': None,
+                    'imagebase': None,
+                    'cert_table_addr': None,
+                    'cert_va': 0x0,
+                    'cert_size': 0x0
+                 }
+
+        if magic in OPTIONAL_HEADER_LAYOUTS:
+            imagebase_offset, fields, certificate_table_offset = OPTIONAL_HEADER_LAYOUTS[magic]
+            imagebase, _, certificate_virtual_addr, certificate_size = fields.unpack_from(content, nt_headers_addr+imagebase_offset)
+
+            layout['imagebase_addr'] = nt_headers_addr + imagebase_offset
+            layout['imagebase'] = imagebase
+            layout['cert_table_addr'] = nt_headers_addr + certificate_table_offset
+            layout['cert_va'] = certificate_virtual_addr
+            layout['cert_size'] = certificate_size
+
+        return layout
+
+    def verify_signature(self, cert):
         '''
         We need to skip _WIN_CERTIFICATE attributes and work only on bCertificate (PKCS #7 signed data)
 
@@ -114,30 +219,40 @@ class SigValidator:
 
         signature = cert[0x4+0x2+0x2:]
 
-        self.save_data(self.file_signature, signature)
-
-        # openssl asn1parse -inform DER -in /tmp/tmp0UGO2s
-        process = subprocess.Popen(['openssl', 'asn1parse', '-inform', 'DER', '-in', self.file_signature], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output = process.communicate()[0].decode("utf-8").split('\n')
-
-        where = [i for i, item in enumerate(output) if SPC_PE_IMAGE_DATA_OBJID in item]
+        if default_backend:
+            return self.verify_signed_data(signature)
 
-        if where:
-            match = OPENSSL_REGEX.search(output[where[0]-2])
+        content = self.get_signed_content(signature)
 
-            offset = int(match.group('offset'))
-            header_length = int(match.group('header_length'))
-            length = int(match.group('length'))
+        if content is not None:
+            # Nothing is written to disk: signature is given through stdin, and signed content through a pipe
+            read_fd, write_fd = os.pipe()
 
-            content = signature[offset+header_length:offset+header_length+length]
-            self.save_data(self.file_signed_data, content)
-
-            # openssl smime -verify -inform DER -in /tmp/tmpt8qzo4d6 -binary -content /tmp/tmpjoakp92x -purpose any -CApath /etc/ssl/certs/ -out /tmp/dummy.txt
-            process = subprocess.Popen(['openssl', 'smime', '-verify', '-inform', 'DER', '-in', self.file_signature,
-                                        '-binary', '-content', self.file_signed_data, '-purpose', 'any', '-CApath',
-                                        '/etc/ssl/certs/', '-out', '/tmp/dummy.txt'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            popen_args = {'stdin': subprocess.PIPE, 'stdout': subprocess.PIPE, 'stderr': subprocess.PIPE}
+            # Python 3 does not let child processes inherit file descriptors, unless told so
+            if hasattr(os, 'set_inheritable'):
+                popen_args['pass_fds'] = (read_fd,)
+            # Python 2 lets them inherit all of them, openssl would never read the end of content
+            else:
+                popen_args['preexec_fn'] = lambda: os.close(write_fd)
+
+            # openssl smime -verify -inform DER -binary -content /dev/fd/3 -purpose any -CApath /etc/ssl/certs/ -out /dev/null
+            try:
+                process = subprocess.Popen(['openssl', 'smime', '-verify', '-inform', 'DER', '-binary',
+                                            '-content', '/dev/fd/{0}'.format(read_fd), '-purpose', 'any', '-CApath',
+                                            CA_PATH, '-out', os.devnull], **popen_args)
+            except OSError:
+                os.close(write_fd)
+                raise
+            finally:
+                os.close(read_fd)
+
+            # Content holds page hashes of '/ph' signed images, it can exceed pipe buffer: write it while openssl reads
+            writer = threading.Thread(target=self.write_pipe, args=(write_fd, content))
+            writer.start()
+            output = process.communicate(signature)[1].decode("utf-8")
+            writer.join()
 
-            output = process.communicate()[1].decode("utf-8")
             result = output.split(':')[-1].replace('\n', '')
 
             if result:
@@ -148,24 +263,273 @@ class SigValidator:
         else:
             return ReturnCode.CERT_FORMAT_ERROR
 
-    def extract_cert(self, pe):
+    def write_pipe(self, fd, data):
         '''
-        Extracts _WIN_CERTIFICATE structure specified in Security directory entry
+        Writes data to a pipe, and closes it
 
-        @param pe: pefile.PE object
+        @param fd: pipe write end
+        @param data: data to write
+        '''
 
-        @return _WIN_CERTIFICATE
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        # Reader exited without reading everything, v.g: malformed signature
+        except (IOError, OSError):
+            pass
+
+    def get_signed_content(self, signature):
         '''
+        Gets content signed by Authenticode, walking PKCS #7 signed data structure
 
-        if self.has_cert(pe):
-            security_directory = pe.OPTIONAL_HEADER.DATA_DIRECTORY[pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_SECURITY']]
+        @param signature: PKCS #7 signed data
 
-            return pe.__data__[security_directory.VirtualAddress:security_directory.VirtualAddress+security_directory.Size]
+        @return SpcIndirectDataContent without its tag and length, or None if not found
+        '''
+
+        try:
+            content_info = cms.ContentInfo.load(signature)['content']['encap_content_info']
+
+            if content_info['content_type'].dotted == SPC_INDIRECT_DATA_OBJID:
+                return content_info['content'].contents
+        except (ValueError, TypeError, KeyError, IndexError):
+            pass
+
+    def verify_signed_data(self, signature):
+        '''
+        Verifies PKCS #7 signed data in-process, as 'openssl smime -verify -purpose any' does
+
+        @param signature: PKCS #7 signed data
+
+        @return string with verification process result, in openssl terms
+        '''
+
+        # asn1crypto parses fields lazily, malformed data can raise at any step of verification
+        # (UnicodeDecodeError is a ValueError, as unknown algorithm errors are)
+        try:
+            return self.check_signed_data(signature)
+        except (ValueError, TypeError, KeyError, IndexError):
+            return ReturnCode.CERT_FORMAT_ERROR
+
+    def check_signed_data(self, signature):
+        '''
+        Verifies PKCS #7 signed data, see verify_signed_data()
+
+        @param signature: PKCS #7 signed data
+
+        @return string with verification process result, in openssl terms
+        '''
+
+        signed_data = cms.ContentInfo.load(signature)['content']
+        content_info = signed_data['encap_content_info']
+
+        if content_info['content_type'].dotted != SPC_INDIRECT_DATA_OBJID:
+            return ReturnCode.CERT_FORMAT_ERROR
+
+        # Signed content is SpcIndirectDataContent without its tag and length
+        content = content_info['content'].contents
+
+        signer_info = signed_data['signer_infos'][0]
+        certificates = [c.chosen for c in signed_data['certificates'] if c.name == 'certificate']
+        signer = self.find_signer(signer_info, certificates)
+
+        if not signer:
+            return 'Signer certificate not found'
+
+        # Like openssl, verify signer certificate first
+        result = self.verify_chain(signer, certificates)
+        if result:
+            return result
+
+        digest_algorithm = signer_info['digest_algorithm']['algorithm'].native
+        signed_attrs = signer_info['signed_attrs']
+
+        if isinstance(signed_attrs, core.Void):
+            signed_content = content
+        else:
+            message_digest = None
+            for attribute in signed_attrs:
+                if attribute['type'].native == 'message_digest':
+                    message_digest = attribute['values'][0].native
 
-    def has_cert(self, pe):
-        security_directory = pe.OPTIONAL_HEADER.DATA_DIRECTORY[pefile.DIRECTORY_ENTRY['IMAGE_DIRECTORY_ENTRY_SECURITY']]
+            if message_digest != hashlib.new(digest_algorithm, content).digest():
+                return 'Digest failure'
 
-        return (security_directory.Size and security_directory.VirtualAddress) != 0x0
+            # Signature covers attributes encoded as SET OF, not with its [0] IMPLICIT tag
+            signed_content = signed_attrs.untag().dump()
+
+        if not self.verify_raw_signature(signer, signer_info['signature'].native, signed_content,
+                                         signer_info['signature_algorithm'].signature_algo, digest_algorithm):
+            return 'Signature failure'
+
+        return 'Verification successful'
+
+    def find_signer(self, signer_info, certificates):
+        '''
+        Gets certificate identified by SignerInfo.sid
+
+        @param signer_info: cms.SignerInfo
+        @param certificates: list of x509.Certificate embedded in signed data
+
+        @return x509.Certificate, or None if not found
+        '''
+
+        sid = signer_info['sid']
+
+        for certificate in certificates:
+            if sid.name == 'issuer_and_serial_number':
+                if certificate.issuer == sid.chosen['issuer'] and certificate.serial_number == sid.chosen['serial_number'].native:
+                    return certificate
+            elif certificate.key_identifier == sid.chosen.native:
+                return certificate
+
+    def verify_chain(self, certificate, certificates):
+        '''
+        Builds certificate chain up to a trusted certificate of CA_PATH, and verifies it
+
+        @param certificate: x509.Certificate to verify
+        @param certificates: list of x509.Certificate embedded in signed data, used as intermediates
+
+        @return None if chain is valid, or string with the error in openssl terms
+        '''
+
+        trust_roots = self.load_trust_roots()
+        chain = [certificate]
+
+        while True:
+            current = chain[-1]
+
+            # Certificate itself is trusted
+            if current.dump() in [c.dump() for c in trust_roots.get(current.subject.hashable, [])]:
+                break
+
+            issuer = self.find_issuer(current, trust_roots.get(current.issuer.hashable, []))
+            if issuer:
+                chain += [issuer]
+                break
+
+            if current.self_signed != 'no':
+                return 'Self signed certificate' if len(chain) == 1 else 'Self signed certificate in certificate chain'
+
+            issuer = self.find_issuer(current, [c for c in certificates if c not in chain])
+            if not issuer or len(chain) >= MAX_CHAIN_DEPTH:
+                return 'Unable to get local issuer certificate'
+
+            chain += [issuer]
+
+        # Trusted certificate (last one) can be a v1 certificate without BasicConstraints
+        for issuer in chain[1:-1]:
+            if not issuer.ca:
+                return 'Invalid CA certificate'
+
+        now = datetime.datetime.now(util.timezone.utc)
+
+        # From trusted certificate down to signer, as openssl does
+        for i in reversed(range(len(chain))):
+            current = chain[i]
+
+            if i < len(chain) - 1 and not self.verify_cert_signature(current, chain[i+1]):
+                return 'Certificate signature failure'
+
+            if now < current.not_valid_before:
+                return 'Certificate is not yet valid'
+            elif now > current.not_valid_after:
+                return 'Certificate has expired'
+
+    def find_issuer(self, certificate, candidates):
+        '''
+        Gets issuer of a certificate among candidates, preferring those whose signature matches
+
+        @param certificate: x509.Certificate
+        @param candidates: list of x509.Certificate
+
+        @return x509.Certificate, or None if not found
+        '''
+
+        issuers = [c for c in candidates if c.subject == certificate.issuer]
+
+        for issuer in issuers:
+            if self.verify_cert_signature(certificate, issuer):
+                return issuer
+
+        if issuers:
+            return issuers[0]
+
+    def verify_cert_signature(self, certificate, issuer):
+        signature_algorithm = certificate['signature_algorithm']
+
+        return self.verify_raw_signature(issuer, certificate['signature_value'].native, certificate['tbs_certificate'].dump(),
+                                         signature_algorithm.signature_algo, signature_algorithm.hash_algo)
+
+    def verify_raw_signature(self, certificate, signature, data, signature_algorithm, hash_algorithm):
+        '''
+        Verifies a signature with the public key of a certificate
+
+        @param certificate: x509.Certificate of signer
+        @param signature: signature bytes
+        @param data: signed data
+        @param signature_algorithm: rsassa_pkcs1v15 or ecdsa
+        @param hash_algorithm: md5, sha1, sha256, or other hash contained in cryptography.hazmat.primitives.hashes
+
+        @return True if signature is valid
+        '''
+
+        try:
+            public_key = serialization.load_der_public_key(certificate.public_key.dump(), default_backend())
+            hash_ = getattr(hashes, hash_algorithm.upper())()
+
+            if signature_algorithm == 'rsassa_pkcs1v15':
+                public_key.verify(signature, data, padding.PKCS1v15(), hash_)
+            elif signature_algorithm == 'ecdsa':
+                public_key.verify(signature, data, ec.ECDSA(hash_))
+            else:
+                return False
+        # TypeError, AttributeError, UnsupportedAlgorithm: unexpected key type or hash algorithm
+        except (InvalidSignature, UnsupportedAlgorithm, ValueError, TypeError, AttributeError):
+            return False
+
+        return True
+
+    def load_trust_roots(self):
+        '''
+        Loads certificates of CA_PATH
+
+        @return a dict of lists of x509.Certificate, by subject
+        '''
+
+        if self._trust_roots is None:
+            self._trust_roots = {}
+
+            if os.path.isdir(CA_PATH):
+                for f in os.listdir(CA_PATH):
+                    if CA_PATH_FILE_REGEX.match(f):
+                        data = self.read_data(os.path.join(CA_PATH, f))
+                        if pem.detect(data):
+                            _, _, data = pem.unarmor(data)
+
+                        try:
+                            certificate = x509.Certificate.load(data)
+                            self._trust_roots.setdefault(certificate.subject.hashable, []).append(certificate)
+                        except ValueError:
+                            pass
+
+        return self._trust_roots
+
+    def extract_cert(self, context):
+        '''
+        Extracts _WIN_CERTIFICATE structure specified in Security directory entry
+
+        @param context: PEContext
+
+        @return _WIN_CERTIFICATE
+        '''
+
+        if self.has_cert(context):
+            # Content may be a bytearray, but asn1crypto only loads bytes
+            return bytes(context.content[context.cert_va:context.cert_va+context.cert_size])
+
+    def has_cert(self, context):
+        return (context.cert_size and context.cert_va) != 0x0
 
     def get_digest_from_signature(self, signature):
         # $ openssl asn1parse -inform DER -in signature.der
@@ -177,14 +541,10 @@ class SigValidator:
         OID_sha1 = binascii.unhexlify('2b0e03021a')                 # sha1
         OID_sha256 = binascii.unhexlify('608648016503040201')       # sha256
 
-        match = CERTIFICATE_REGEX.search(signature)
+        matches = self.find_certificate_hashes(signature, first=True)
 
-        if match:
-            oid_algorithm = match.group('oid_algorithm')
-            hash_size = ord(match.group('hash_size'))
-            where = match.end()
-
-            digest = signature[where:where+hash_size]
+        if matches:
+            oid_algorithm, digest = matches[0]
 
             if oid_algorithm == OID_md5:
                 return 'md5', digest
@@ -195,12 +555,12 @@ class SigValidator:
         else:
             return None, 0x00
 
-    def calculate_pe_digest(self, algorithm, raw_data):
+    def calculate_pe_digest(self, algorithm, context):
         '''
         Calculate Authenticode hash given an algorithm
 
         @param algoritm: md5, sha1, sha256, or other function contained in hashlib
-        @param raw_data: PE raw data
+        @param context: PEContext
 
         @return calculated hash string
         '''
@@ -208,23 +568,36 @@ class SigValidator:
         # Skip parts omitted by Authenticode hash algorithm
         # http://download.microsoft.com/download/9/c/5/9c5b2167-8017-4bae-9fde-d599bac8184a/authenticode_pe.docx
 
-        nt_headers_addr = self.get_nt_header_addr(raw_data)
-        checksum_addr = nt_headers_addr + 0x58
+        raw_data = context.content
+        checksum_addr = context.checksum_addr
+
+        certificate_table_addr = context.cert_table_addr
+        certificate_virtual_addr = context.cert_va
+        certificate_size = context.cert_size
+
+        # Hash zero-copy slices instead of building a copy of the whole image
+        try:
+            view = memoryview(raw_data)
+        # Python 2 mmap objects (pefile.PE(path)) don't support memoryview
+        except TypeError:
+            view = raw_data
 
-        certificate_table_addr, certificate_virtual_addr, certificate_size = self.get_pe_certificate_attibutes(raw_data)
+        h = getattr(hashlib, algorithm)()
 
         # PE header except OptionalHeader.CheckSum and OptionalHeader.SecurityDirectoryEntry, because those fields are modified
         # due to the sign process itself
-        data = raw_data[:checksum_addr] + raw_data[checksum_addr+0x04:certificate_table_addr]
+        h.update(view[:checksum_addr])
+        h.update(view[checksum_addr+0x04:certificate_table_addr])
 
         # Skip only embedded signature, there can be data after it
         if (certificate_virtual_addr and certificate_size) != 0x0:
-            data += raw_data[certificate_table_addr+0x08:certificate_virtual_addr] + raw_data[certificate_virtual_addr+certificate_size:]
+            h.update(view[certificate_table_addr+0x08:certificate_virtual_addr])
+            h.update(view[certificate_virtual_addr+certificate_size:])
         # Or don't skip anything if signature is not present
         else:
-            data += raw_data[certificate_table_addr+0x08:]
+            h.update(view[certificate_table_addr+0x08:])
 
-        return getattr(hashlib, algorithm)(data).digest()
+        return h.digest()
 
     def get_nt_header_addr(self, pe_data):
         '''
@@ -240,76 +613,283 @@ class SigValidator:
             if nt_headers == b'\x50\x45\x00\x00':   # PE
                 return nt_headers_addr
 
-    def get_pe_certificate_attibutes(self, pe_data):
+    def unpack_dword(self, bytes_):
+        return struct.unpack('<I', bytes_)[0]
+
+    def is_in_catalog(self, digest):
+        return digest in self.get_catalog_digests()
+
+    def get_catalog_digests(self):
+        if self._catalog_digests is None:
+            self._catalog_digests = self.load_catalog_digests()
+
+        return self._catalog_digests
+
+    def load_catalog_digests(self):
         '''
-        Gets SecurityDirectoryEntry offset and its attributes
+        Collects all digests contained in catalog files. The result is persisted in CACHE_DIR,
+        and reused while catalog files are not modified
 
-        @param pe_data: PE raw data
+        @return a set of digests
+        '''
 
-        @return tuple with SecurityDirectoryEntry offset, SecurityDirectoryEntry.VirtualAddress, SecurityDirectoryEntry.Size
+        # All files are needed to build the key before scanning any of them
+        files = list(self.get_files_by_extension(self.catalog, '.cat'))
+
+        key = repr((os.path.realpath(self.catalog), sum(os.path.getmtime(f) for f in files))).encode('utf-8')
+        cache_dir = self.get_cache_dir()
+        cache_file = None
+
+        if cache_dir:
+            cache_file = os.path.join(cache_dir, 'catalog-{0}.digests'.format(hashlib.md5(key).hexdigest()))
+            digests = self.read_digests(cache_file, key)
+            if digests is not None:
+                return digests
+
+        digests = set()
+        for f in files:
+            # Empty files cannot be mapped
+            if not os.path.getsize(f):
+                continue
+
+            data = self.map_data(f)
+            try:
+                digests.update(self.extract_hashes(data))
+            finally:
+                data.close()
+
+        if cache_file:
+            self.write_digests(cache_file, key, digests)
+
+        return digests
+
+    def get_cache_dir(self):
+        '''
+        Creates CACHE_DIR if needed, only accessible by current user
+
+        @return CACHE_DIR, or None if it cannot be trusted
         '''
-        nt_headers = self.get_nt_header_addr(pe_data)
 
-        if self.is_32bits(pe_data):
-            certificate_table_addr = nt_headers + 0x98
-        elif self.is_64bits(pe_data):
-            certificate_table_addr = nt_headers + 0xa8
+        try:
+            os.makedirs(CACHE_DIR, 0o700)
+        except OSError:
+            pass
 
-        certificate_virtual_addr = self.unpack_dword(pe_data[certificate_table_addr:certificate_table_addr+0x04])
-        certificate_size = self.unpack_dword(pe_data[certificate_table_addr+0x04:certificate_table_addr+0x08])
+        try:
+            st = os.lstat(CACHE_DIR)
+        except OSError:
+            return None
 
-        return certificate_table_addr, certificate_virtual_addr, certificate_size
+        # Other users must not be able to plant a cache file
+        if not stat.S_ISDIR(st.st_mode) or st.st_mode & 0o022 or not self.is_owned(st):
+            return None
 
-    def is_32bits(self, content):
-        nt_headers_addr = self.get_nt_header_addr(content)
-            
-        magic = content[nt_headers_addr+0x18:nt_headers_addr+0x18+0x2]
+        return CACHE_DIR
 
-        return magic == b'\x0B\x01'
+    def is_owned(self, st):
+        # There are no file owners to check on Windows
+        return not hasattr(os, 'getuid') or st.st_uid == os.getuid()
 
-    def is_64bits(self, content):
-        nt_headers_addr = self.get_nt_header_addr(content)
-            
-        magic = content[nt_headers_addr+0x18:nt_headers_addr+0x18+0x2]
+    def read_digests(self, filename, key):
+        '''
+        Reads digests persisted by write_digests()
 
-        return magic == b'\x0B\x02'
+        @param filename: cache file
+        @param key: bytes identifying catalog files state
 
-    def unpack_dword(self, bytes_):
-        return struct.unpack('<I', bytes_)[0]
+        @return a set of digests, or None if cache is missing, invalid, or built for another key
+        '''
 
-    def is_in_catalog(self, digest):
-        files = self.get_files_by_extension(self.catalog, '.cat')
+        try:
+            # Do not follow a symbolic link planted in place of cache file
+            fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0))
+        except OSError:
+            return None
+
+        with os.fdopen(fd, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or not self.is_owned(st):
+                return None
+
+            data = bytearray(f.read())
+
+        # Key, then digests, all of them prefixed with their length
+        try:
+            key_size = struct.unpack_from('<I', data)[0]
+            if bytes(data[4:4+key_size]) != key:
+                return None
+
+            digests = set()
+            where = 4 + key_size
+            while where < len(data):
+                size = data[where]
+                digest = bytes(data[where+1:where+1+size])
+                if len(digest) != size:
+                    return None
+
+                digests.add(digest)
+                where += 1 + size
+        except struct.error:
+            return None
+
+        return digests
+
+    def write_digests(self, filename, key, digests):
+        '''
+        Persists digests, see read_digests()
 
-        for f in files:
-            data = self.read_data(f)
+        @param filename: cache file
+        @param key: bytes identifying catalog files state
+        @param digests: set of digests
+        '''
+
+        ret = [struct.pack('<I', len(key)), key]
+        for digest in digests:
+            ret += [struct.pack('<B', len(digest)), digest]
+
+        # Written aside, then renamed: readers never see a partial file
+        try:
+            fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(filename))
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b''.join(ret))
+            os.rename(temp_file, filename)
+        except (IOError, OSError):
+            self.delete_file(temp_file)
+
+    def delete_file(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def compile_certificate_db(self):
+        '''
+        Compiles CERTIFICATE_PATTERN into a Hyperscan database, if available
+
+        @return hyperscan.Database, or None to fall back to CERTIFICATE_REGEX
+        '''
+
+        if not hyperscan:
+            return None
+
+        # Hyperscan does not support capturing groups
+        pattern = re.sub(br'\(\?P<[a-z_]+>(.*?)\)', br'\1', CERTIFICATE_PATTERN)
+
+        db = hyperscan.Database()
+        db.compile(expressions=[pattern], ids=[0], elements=1, flags=[hyperscan.HS_FLAG_SOM_LEFTMOST])
+
+        return db
+
+    def find_certificate_hashes(self, data, first=False):
+        '''
+        Finds DigestInfo structures (algorithm identifier followed by a hash) in DER data
+
+        @param data: raw data to scan, v.g: PKCS #7 signed data or catalog file
+        @param first: stop scanning at first match
+
+        @return a list of tuples of algorithm OID and digest, in that order
+        '''
+
+        ret = []
+
+        if self.certificate_db:
+            # \x30 . \x30 . \x06 . precede the OID, \x05 \x00 \x04 . follow it
+            def on_match(id_, start, end, flags, context):
+                hash_size = ord(data[end-1:end])
+                ret.append((data[start+6:end-4], data[end:end+hash_size]))
+                return first
+
+            try:
+                self.certificate_db.scan(data, match_event_handler=on_match)
+            # Raised when on_match stops the scan
+            except hyperscan.ScanTerminated:
+                pass
+        else:
             for match in CERTIFICATE_REGEX.finditer(data):
-                oid_algorithm = match.group('oid_algorithm')
                 hash_size = ord(match.group('hash_size'))
                 where = match.end()
 
-                hash_digest = data[where:where+hash_size]
+                ret += [(match.group('oid_algorithm'), data[where:where+hash_size])]
 
-                if digest == hash_digest:
-                    return True
+                if first:
+                    break
 
-        return False
+        return ret
+
+    def extract_hashes(self, data):
+        '''
+        Extracts all digests of DigestInfo structures in DER data. Unlike find_certificate_hashes,
+        it skips algorithm OIDs to do as little work as possible per match (catalog files have thousands)
+
+        @param data: raw data to scan, v.g: catalog file
+
+        @return a list of digests
+        '''
 
-    def get_files_by_extension(self, path, extension):
         ret = []
 
-        if os.path.isdir(path):
-            for root, _, files in os.walk(path):
-                for f in files:
-                    _, ext = os.path.splitext(f)
-                    if ext == extension:
-                        ret += [os.path.join(root, f)]
+        if self.certificate_db:
+            # Last matched byte is the hash size
+            def on_match(id_, start, end, flags, context):
+                ret.append(data[end:end+ord(data[end-1:end])])
+
+            self.certificate_db.scan(data, match_event_handler=on_match)
+        else:
+            for match in CERTIFICATE_REGEX.finditer(data):
+                where = match.end()
+                ret.append(data[where:where+ord(data[where-1:where])])
 
         return ret
 
+    def get_files_by_extension(self, path, extension):
+        '''
+        Walks a directory tree looking for files, relying on directory entry types instead of stat-ing every entry
+
+        @param path: directory to walk
+        @param extension: file extension, v.g: '.cat'
+
+        @return a generator of file paths
+        '''
+
+        if not os.path.isdir(path):
+            return
+
+        if not scandir:
+            for root, _, files in os.walk(path):
+                for f in files:
+                    if f.endswith(extension):
+                        yield os.path.join(root, f)
+            return
+
+        # Symbolic links to directories are not followed, as os.walk() does
+        directories = [path]
+        while directories:
+            try:
+                entries = list(scandir(directories.pop()))
+            # Unreadable or vanished directory, skip it as os.walk() does
+            except OSError:
+                continue
+
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories += [entry.path]
+                elif entry.name.endswith(extension) and entry.is_file():
+                    yield entry.path
+
     def read_data(self, filename):
         with open(filename, 'rb') as f:
             return f.read()
 
-    def save_data(self, filename, file_content):
-        with open(filename, 'wb') as f:
-            f.write(file_content)
+    def map_data(self, filename):
+        '''
+        Maps a file into memory, so its pages are only loaded when accessed
+
+        @param filename: file to map, must not be empty
+
+        @return read-only mmap.mmap, to be closed by caller
+        '''
+
+        with open(filename, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)